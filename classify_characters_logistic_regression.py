@@ -1,11 +1,16 @@
 import os
+import shutil
+import hashlib
+from pathlib import Path
 import string
-import random
 
 import numpy as np
 from scipy.io import loadmat
 from scipy.ndimage import gaussian_filter1d
+from joblib import Parallel, delayed
+from numba import njit, prange
 from sklearn.linear_model import LogisticRegression
+from sklearn.multiclass import OneVsRestClassifier
 from sklearn.metrics import confusion_matrix
 from matplotlib import pyplot as plt
 
@@ -29,14 +34,46 @@ CHAR_REPLACEMENTS = {
 }
 CHAR_TO_CLASS_MAP = {char: idx for idx, char in enumerate(ALL_CHARS)}
 CLASS_TO_CHAR_MAP = {idx: char for idx, char in enumerate(ALL_CHARS)}
+# The characters in sorted order alongside their classes, to convert whole arrays of
+# characters to classes with a binary search.
+SORTED_CHARS = np.array(sorted(ALL_CHARS))
+SORTED_CHAR_CLASSES = np.array(
+    [CHAR_TO_CLASS_MAP[char] for char in SORTED_CHARS], dtype=np.int8
+)
 
 REACTION_TIME_BINS = 10
 TRAINING_WINDOW_BINS = 150
 
 NUM_ELECTRODES = 192
 
+# NUM_SESSIONS = 1
+NUM_SESSIONS = None
+
+SMOOTHING_STDDEV = 3.0
+
+RANDOM_SEED = 0
+
+# Whether to cache the organized train/test data on disk (compressed, one file per seed
+# and electrode limit), to skip preprocessing on later runs.
+CACHE_ORGANIZED_DATA = False
+# Bump this whenever a change to organize_data changes its output for the same data and
+# settings, so stale cached data isn't reused.
+ORGANIZED_DATA_CACHE_VERSION = 2
+
 OUTPUTS_DIR = os.path.abspath("./outputs")
 
+# The arrays we use from each session's .mat file.
+MAT_KEYS = [
+    "neuralActivityTimeSeries",
+    "goPeriodOnsetTimeBin",
+    "delayPeriodOnsetTimeBin",
+    "characterCues",
+    "blockNumsTimeSeries",
+    "blockList",
+    "meansPerBlock",
+    "stdAcrossAllData",
+]
+
 
 ########################################################################################
 # Main functions.
@@ -93,113 +130,139 @@ def load_data():
 
     data_dicts = []
     for filepath in letters_filepaths:
-        print(f"Loading {filepath} ...")
-        data_dict = loadmat(filepath)
+        # Convert the .mat file to .npy files the first time through (and again whenever
+        # the .mat file changes), so every load after that can memory-map the arrays
+        # instead of reading the whole file.
+        npy_dirpath = os.path.splitext(filepath)[0] + "_npy"
+        if not npy_dir_is_current(filepath, npy_dirpath):
+            print(f"Converting {filepath} ...")
+            convert_mat_to_npy(filepath, npy_dirpath)
+        print(f"Loading {npy_dirpath} ...")
+        data_dict = load_npy_dir(npy_dirpath)
+        # Keep track of where the data came from, to identify it in cached results.
+        data_dict["filepath"] = filepath
         data_dicts.append(data_dict)
 
     return data_dicts
 
 
-def organize_data(data_dicts, limit_electrodes=None, limit_train_trials=None):
+def convert_mat_to_npy(mat_filepath, npy_dirpath):
     """"""
+    mat_dict = loadmat(mat_filepath)
+    arrays = {key: mat_dict[key] for key in MAT_KEYS}
+    # Work in float32 from here on, to halve the memory used by the neural data.
+    arrays["neuralActivityTimeSeries"] = arrays["neuralActivityTimeSeries"].astype(
+        np.float32
+    )
+    # Unwrap the cell array of characters into a plain array of strings, which (unlike
+    # an object array) can be memory-mapped.
+    arrays["characterCues"] = np.array([a[0] for a in arrays["characterCues"].ravel()])
+    # Record which version of the .mat file the arrays came from.
+    arrays["source_stat"] = get_source_stat(mat_filepath)
+    save_npy_dir(npy_dirpath, arrays)
 
-    print("Preparing data ...")
 
-    X_train = []
-    X_test = []
-    y_train = []
-    y_test = []
+def get_source_stat(mat_filepath):
+    """"""
+    file_stat = os.stat(mat_filepath)
+    return np.array([file_stat.st_size, file_stat.st_mtime_ns], dtype=np.int64)
 
-    # Random electrode order to let us limit electrodes.
-    rand_electrode_order = list(range(NUM_ELECTRODES))
-    random.shuffle(rand_electrode_order)
-
-    # Iterate through the sessions.
-    # NUM_SESSIONS = 1
-    NUM_SESSIONS = None
-    for data_dict in data_dicts[:NUM_SESSIONS]:
-        neural = data_dict["neuralActivityTimeSeries"]
-        go_cue_bins = data_dict["goPeriodOnsetTimeBin"].ravel().astype(int)
-        delay_cue_bins = data_dict["delayPeriodOnsetTimeBin"].ravel().astype(int)
-        prompts = np.array([a[0] for a in data_dict["characterCues"].ravel()])
-        block_by_bin = data_dict["blockNumsTimeSeries"].ravel()
-        block_nums = data_dict["blockList"].ravel()
-
-        # If specified, only use a random subset of electrodes.
-        if limit_electrodes is not None:
-            neural = neural[:, rand_electrode_order[:limit_electrodes]]
-
-        # Iterate through each block in this session.
-        for block_num in block_nums:
-            # Get means and stddevs from a random set of train trials in the block, and
-            # the rest of the trials can be used for test.
-            block_trial_mask = [block_by_bin[b] == block_num for b in go_cue_bins]
-            num_trials_in_block = sum(block_trial_mask)
-            random_trial_idxs = list(range(num_trials_in_block))
-            random.shuffle(random_trial_idxs)
-            train_end_idx = int(num_trials_in_block * 0.8)
-            train_trial_idxs = random_trial_idxs[:train_end_idx]
-            block_go_cue_bins = go_cue_bins[block_trial_mask]
-            block_delay_cue_bins = delay_cue_bins[block_trial_mask]
-            block_prompts = prompts[block_trial_mask]
-            # Loop through the train trials and add the neural data to our list.
-            neural_to_zscore_based_on = []
-            for trial_idx in train_trial_idxs:
-                # For convenience, ignore the last trial in the block.
-                if trial_idx + 1 >= len(block_delay_cue_bins):
-                    continue
-                start_bin = block_delay_cue_bins[trial_idx]
-                end_bin = block_delay_cue_bins[trial_idx + 1]
-                neural_to_zscore_based_on.extend(neural[start_bin:end_bin])
-            neural_to_zscore_based_on = np.array(neural_to_zscore_based_on)
-            block_means = np.mean(neural_to_zscore_based_on, axis=0)
-            block_stddevs = np.std(neural_to_zscore_based_on, axis=0)
-
-            for trial_idx in range(num_trials_in_block):
-                # Get the training window for this trial.
-                go_cue_bin = block_go_cue_bins[trial_idx]
-                window_start_bin = int(go_cue_bin) + REACTION_TIME_BINS
-                window_end_bin = window_start_bin + TRAINING_WINDOW_BINS
-                # Get the neural data in this window.
-                trial_neural = neural[window_start_bin:window_end_bin]
-                # Z-score the neural data using the block-specific means and stddevs.
-                with np.errstate(divide="ignore", invalid="ignore"):
-                    trial_zscored_neural = (trial_neural - block_means) / block_stddevs
-                trial_zscored_neural = np.nan_to_num(
-                    trial_zscored_neural, nan=0, posinf=0, neginf=0
-                )
 
-                # Get the character for this trial.
-                trial_label = block_prompts[trial_idx]
-
-                # Skip rest trials.
-                if trial_label == "doNothing":
-                    continue
-
-                # Add the trial to the appropriate set of data (train or test).
-                if trial_idx in train_trial_idxs:
-                    X_train.append(trial_zscored_neural)
-                    y_train.append(trial_label)
-                else:
-                    X_test.append(trial_zscored_neural)
-                    y_test.append(trial_label)
-
-    # Smooth the neural data over time.
-    SMOOTHING_STDDEV = 3.0
-    X_train = np.array(
-        [gaussian_filter1d(w, sigma=SMOOTHING_STDDEV, axis=0) for w in X_train]
-    )
-    X_test = np.array(
-        [gaussian_filter1d(w, sigma=SMOOTHING_STDDEV, axis=0) for w in X_test]
-    )
+def npy_dir_is_current(mat_filepath, npy_dirpath):
+    """"""
+    source_stat_filepath = os.path.join(npy_dirpath, "source_stat.npy")
+    if not os.path.isfile(source_stat_filepath):
+        return False
+    return np.array_equal(np.load(source_stat_filepath), get_source_stat(mat_filepath))
 
-    # Flatten each trial's neural data since the model operates on 1D vectors.
-    X_train = np.reshape(X_train, (X_train.shape[0], -1))
-    X_test = np.reshape(X_test, (X_test.shape[0], -1))
 
-    # Convert the characters to ints, for compatibility with pytorch.
-    y_train = np.array([CHAR_TO_CLASS_MAP[ch] for ch in y_train])
-    y_test = np.array([CHAR_TO_CLASS_MAP[ch] for ch in y_test])
+def save_npy_dir(dirpath, arrays):
+    """"""
+    # Write to a temporary directory and rename it at the end, so an interrupted save
+    # doesn't leave behind a partial directory that looks complete.
+    tmp_dirpath = dirpath + ".tmp"
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    Path(tmp_dirpath).mkdir(parents=True)
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_dirpath, f"{key}.npy"), array)
+    # Replace any outdated directory from an earlier save.
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.rename(tmp_dirpath, dirpath)
+
+
+def load_npy_dir(dirpath):
+    """"""
+    return {
+        os.path.splitext(filename)[0]: np.load(
+            os.path.join(dirpath, filename), mmap_mode="r"
+        )
+        for filename in sorted(os.listdir(dirpath))
+        if filename.endswith(".npy")
+    }
+
+
+def chars_to_classes(chars):
+    """"""
+    # Find where each character sits among the sorted characters and take the class
+    # there. Characters that aren't one of the classes (i.e. rest) get -1.
+    chars = np.asarray(chars)
+    sorted_idxs = np.searchsorted(SORTED_CHARS, chars)
+    sorted_idxs = np.minimum(sorted_idxs, len(SORTED_CHARS) - 1)
+    is_class = SORTED_CHARS[sorted_idxs] == chars
+    return np.where(is_class, SORTED_CHAR_CLASSES[sorted_idxs], -1).astype(np.int8)
+
+
+def organize_data(
+    data_dicts, limit_electrodes=None, limit_train_trials=None, seed=None
+):
+    """"""
+
+    # With a seed the organized data is deterministic, so (if enabled) it can be cached
+    # on disk and reused by later runs with the same data and settings.
+    cache_filepath = None
+    if CACHE_ORGANIZED_DATA and seed is not None:
+        # Identify each session's data by the .mat file stats stored with the arrays
+        # actually read, rather than by the .mat file itself.
+        cache_settings = (
+            ORGANIZED_DATA_CACHE_VERSION,
+            [
+                (data_dict["filepath"], tuple(data_dict["source_stat"].tolist()))
+                for data_dict in data_dicts[:NUM_SESSIONS]
+            ],
+            REACTION_TIME_BINS,
+            TRAINING_WINDOW_BINS,
+            SMOOTHING_STDDEV,
+            limit_electrodes,
+            seed,
+        )
+        cache_key = hashlib.sha1(repr(cache_settings).encode()).hexdigest()[:16]
+        cache_filepath = os.path.join(OUTPUTS_DIR, f"organized_data_{cache_key}.npz")
+
+    if cache_filepath is not None and os.path.isfile(cache_filepath):
+        print(f"Loading cached data from {cache_filepath} ...")
+        with np.load(cache_filepath) as organized_arrays:
+            X_train = organized_arrays["X_train"]
+            X_test = organized_arrays["X_test"]
+            y_train = organized_arrays["y_train"]
+            y_test = organized_arrays["y_test"]
+    else:
+        X_train, X_test, y_train, y_test = organize_sessions_data(
+            data_dicts, limit_electrodes, seed
+        )
+        if cache_filepath is not None:
+            # Write to a temporary file and rename it at the end, so an interrupted save
+            # doesn't leave behind a partial file that looks complete.
+            Path(OUTPUTS_DIR).mkdir(parents=True, exist_ok=True)
+            tmp_cache_filepath = cache_filepath + ".tmp"
+            with open(tmp_cache_filepath, "wb") as cache_file:
+                np.savez_compressed(
+                    cache_file,
+                    X_train=X_train,
+                    X_test=X_test,
+                    y_train=y_train,
+                    y_test=y_test,
+                )
+            os.replace(tmp_cache_filepath, cache_filepath)
 
     # If specified, only use a random subset of train trials.
     if limit_train_trials:
@@ -214,6 +277,223 @@ def organize_data(data_dicts, limit_electrodes=None, limit_train_trials=None):
     return X_train, X_test, y_train, y_test
 
 
+def organize_sessions_data(data_dicts, limit_electrodes, seed):
+    """"""
+
+    print("Preparing data ...")
+
+    rng = np.random.default_rng(seed)
+
+    # Random electrode order to let us limit electrodes.
+    rand_electrode_order = rng.permutation(NUM_ELECTRODES)
+    electrode_idxs = None
+    if limit_electrodes is not None:
+        electrode_idxs = rand_electrode_order[:limit_electrodes]
+
+    # Organize each session's trials in parallel, in separate processes. Each session
+    # gets its own independent random generator for splitting its trials into train and
+    # test.
+    session_data_dicts = data_dicts[:NUM_SESSIONS]
+    session_rngs = rng.spawn(len(session_data_dicts))
+    # Use one worker per session (up to the number of cores), so joblib hands each
+    # worker's Numba thread pool the remaining cores for the z-scoring kernel.
+    num_workers = max(min(len(session_data_dicts), os.cpu_count() or 1), 1)
+    session_results = Parallel(n_jobs=num_workers, prefer="processes")(
+        delayed(organize_session_data)(data_dict, electrode_idxs, session_rng)
+        for data_dict, session_rng in zip(session_data_dicts, session_rngs)
+    )
+
+    # Join the sessions' trials together.
+    session_X_trains, session_X_tests, session_y_trains, session_y_tests = zip(
+        *session_results
+    )
+    X_train = np.concatenate(session_X_trains)
+    X_test = np.concatenate(session_X_tests)
+    y_train = np.concatenate(session_y_trains)
+    y_test = np.concatenate(session_y_tests)
+
+    return X_train, X_test, y_train, y_test
+
+
+def organize_session_data(data_dict, electrode_idxs, rng):
+    """"""
+
+    neural = data_dict["neuralActivityTimeSeries"]
+    go_cue_bins = data_dict["goPeriodOnsetTimeBin"].ravel().astype(int)
+    delay_cue_bins = data_dict["delayPeriodOnsetTimeBin"].ravel().astype(int)
+    # Convert the characters to ints, for compatibility with pytorch.
+    prompt_classes = chars_to_classes(data_dict["characterCues"])
+    block_by_bin = data_dict["blockNumsTimeSeries"].ravel()
+    block_nums = data_dict["blockList"].ravel()
+
+    # If specified, only use a subset of electrodes.
+    if electrode_idxs is not None:
+        neural = neural[:, electrode_idxs]
+    # Numba takes a plain ndarray (viewing, not copying, the memory-mapped data).
+    neural = np.asarray(neural)
+    num_channels = neural.shape[1]
+
+    # Get the block each trial belongs to.
+    go_cue_blocks = block_by_bin[go_cue_bins]
+
+    # Count the trials that will go in each set (train or test) ahead of time, so the
+    # arrays holding them can be allocated once up front. Rest trials get skipped later,
+    # so these counts are upper bounds and the arrays are trimmed at the end.
+    max_train_trials = 0
+    max_test_trials = 0
+    for block_num in block_nums:
+        num_trials_in_block = int(np.sum(go_cue_blocks == block_num))
+        num_train_trials_in_block = int(num_trials_in_block * 0.8)
+        max_train_trials += num_train_trials_in_block
+        max_test_trials += num_trials_in_block - num_train_trials_in_block
+
+    # Each trial's neural data is stored flattened since the model operates on 1D
+    # vectors.
+    X_train = np.empty(
+        (max_train_trials, TRAINING_WINDOW_BINS * num_channels), dtype=np.float32
+    )
+    X_test = np.empty(
+        (max_test_trials, TRAINING_WINDOW_BINS * num_channels), dtype=np.float32
+    )
+    y_train = np.empty(max_train_trials, dtype=np.int8)
+    y_test = np.empty(max_test_trials, dtype=np.int8)
+    num_train_trials = 0
+    num_test_trials = 0
+
+    # Iterate through each block in this session.
+    for block_num in block_nums:
+        # Get means and stddevs from a random set of train trials in the block, and
+        # the rest of the trials can be used for test.
+        block_trial_mask = go_cue_blocks == block_num
+        num_trials_in_block = int(block_trial_mask.sum())
+        if num_trials_in_block == 0:
+            continue
+        train_end_idx = int(num_trials_in_block * 0.8)
+        train_trial_idxs = rng.permutation(num_trials_in_block)[:train_end_idx]
+        is_train_trial = np.zeros(num_trials_in_block, dtype=bool)
+        is_train_trial[train_trial_idxs] = True
+        block_go_cue_bins = go_cue_bins[block_trial_mask]
+        block_delay_cue_bins = delay_cue_bins[block_trial_mask]
+        block_prompt_classes = prompt_classes[block_trial_mask]
+        # Gather the neural data of the train trials (each running from its delay cue
+        # to the next trial's) with a single index into the neural data. For
+        # convenience, ignore the last trial in the block.
+        zscore_trial_idxs = train_trial_idxs[train_trial_idxs + 1 < num_trials_in_block]
+        zscore_start_bins = block_delay_cue_bins[zscore_trial_idxs]
+        zscore_num_bins = (
+            block_delay_cue_bins[zscore_trial_idxs + 1] - zscore_start_bins
+        )
+        # Build the bins of all the trials back to back: count up through all of them,
+        # and shift each trial's stretch of the count to start at its start bin.
+        zscore_count_starts = np.cumsum(zscore_num_bins) - zscore_num_bins
+        zscore_bins = np.arange(zscore_num_bins.sum()) + np.repeat(
+            zscore_start_bins - zscore_count_starts, zscore_num_bins
+        )
+        neural_to_zscore_based_on = neural[zscore_bins]
+        # Get the means and stddevs from the sums of the values and of their squares, so
+        # the data isn't read again to subtract the means before taking the stddevs.
+        # Accumulate in float64 to keep the difference of the two precise.
+        num_zscore_bins = neural_to_zscore_based_on.shape[0]
+        zscore_sums = neural_to_zscore_based_on.sum(axis=0, dtype=np.float64)
+        zscore_square_sums = np.einsum(
+            "ij,ij->j",
+            neural_to_zscore_based_on,
+            neural_to_zscore_based_on,
+            dtype=np.float64,
+        )
+        if num_zscore_bins > 0:
+            block_means = zscore_sums / num_zscore_bins
+            block_variances = np.maximum(
+                zscore_square_sums / num_zscore_bins - block_means**2, 0
+            )
+        else:
+            # There are no train trials to get statistics from (e.g. a block with a
+            # single trial), so use zero means and stddevs, which zero out the block's
+            # z-scored data.
+            block_means = np.zeros(num_channels)
+            block_variances = np.zeros(num_channels)
+        block_means = block_means.astype(np.float32)
+        block_stddevs = np.sqrt(block_variances).astype(np.float32)
+
+        # Electrodes with no variance get zeroed out when z-scoring.
+        inv_block_stddevs = np.divide(
+            1.0,
+            block_stddevs,
+            out=np.zeros_like(block_stddevs),
+            where=block_stddevs > 0,
+        )
+
+        # Z-score the windows of the block's train and test trials straight into the
+        # next free rows of the train and test arrays, skipping rest trials.
+        window_start_bins = block_go_cue_bins + REACTION_TIME_BINS
+        if window_start_bins.max() + TRAINING_WINDOW_BINS > neural.shape[0]:
+            raise ValueError("Trial window runs past the end of the neural data.")
+        is_char_trial = block_prompt_classes >= 0
+
+        block_train_mask = is_train_trial & is_char_trial
+        num_block_train_trials = int(block_train_mask.sum())
+        train_rows = slice(num_train_trials, num_train_trials + num_block_train_trials)
+        zscore_trial_windows(
+            neural,
+            window_start_bins[block_train_mask],
+            block_means,
+            inv_block_stddevs,
+            X_train[train_rows],
+        )
+        y_train[train_rows] = block_prompt_classes[block_train_mask]
+        num_train_trials += num_block_train_trials
+
+        block_test_mask = ~is_train_trial & is_char_trial
+        num_block_test_trials = int(block_test_mask.sum())
+        test_rows = slice(num_test_trials, num_test_trials + num_block_test_trials)
+        zscore_trial_windows(
+            neural,
+            window_start_bins[block_test_mask],
+            block_means,
+            inv_block_stddevs,
+            X_test[test_rows],
+        )
+        y_test[test_rows] = block_prompt_classes[block_test_mask]
+        num_test_trials += num_block_test_trials
+
+    # Trim off the unused space left by the skipped rest trials.
+    X_train = X_train[:num_train_trials]
+    X_test = X_test[:num_test_trials]
+    y_train = y_train[:num_train_trials]
+    y_test = y_test[:num_test_trials]
+
+    # Smooth the neural data over time, filtering the whole batch along the time axis in
+    # one call. The filter runs on an unflattened view of each array and writes its
+    # output back in place.
+    for X in [X_train, X_test]:
+        X_unflattened = X.reshape(X.shape[0], TRAINING_WINDOW_BINS, num_channels)
+        gaussian_filter1d(
+            X_unflattened, sigma=SMOOTHING_STDDEV, axis=1, output=X_unflattened
+        )
+
+    return X_train, X_test, y_train, y_test
+
+
+@njit(parallel=True, cache=True)
+def zscore_trial_windows(neural, window_start_bins, means, inv_stddevs, out):
+    """"""
+    # Z-score each trial's window of neural data in a single pass, writing it flattened
+    # into that trial's row of the output. Trials are spread across threads. Any NaNs
+    # (e.g. from NaNs in the neural data) are zeroed out.
+    num_channels = neural.shape[1]
+    num_window_bins = out.shape[1] // num_channels
+    for trial_idx in prange(window_start_bins.shape[0]):
+        window_start_bin = window_start_bins[trial_idx]
+        for bin_idx in range(num_window_bins):
+            for channel_idx in range(num_channels):
+                value = (
+                    neural[window_start_bin + bin_idx, channel_idx] - means[channel_idx]
+                ) * inv_stddevs[channel_idx]
+                if value != value:
+                    value = 0.0
+                out[trial_idx, bin_idx * num_channels + channel_idx] = value
+
+
 def plot_confusion_matrix(y_test, y_pred_test, accuracy_str):
     """"""
 
@@ -257,21 +537,24 @@ def run_multiple_LR(data_dicts, num_electrodes=None, num_train_trials=None, num_
             data_dicts,
             limit_electrodes=num_electrodes,
             limit_train_trials=num_train_trials,
+            seed=RANDOM_SEED + run_idx,
         )
 
         ## Train a logistic regression model on the preprocessed training data.
 
         print("Training logistic regression model ...")
 
-        logistic_regression_model = LogisticRegression(solver="newton-cg")
+        # Fit one-vs-rest so the per-class fits can run in parallel across all cores,
+        # and use a looser tolerance to cut iterations on this noisy neural data.
+        logistic_regression_model = OneVsRestClassifier(
+            LogisticRegression(solver="newton-cg", tol=1e-3), n_jobs=-1
+        )
         logistic_regression_model.fit(X_train, y_train)
 
         ## Evaluate the logistic regression model by calculating accuracy on the test
         ## set.
 
-        y_pred_test = logistic_regression_model.predict(X_test)
-
-        test_accuracy = np.sum(y_pred_test == y_test) / len(y_test)
+        test_accuracy = logistic_regression_model.score(X_test, y_test)
 
         # Store this run's result.
         accuracy_results.append(test_accuracy)
@@ -283,6 +566,7 @@ def run_multiple_LR(data_dicts, num_electrodes=None, num_train_trials=None, num_
 
         show_confusion_matrix = False
         if show_confusion_matrix:
+            y_pred_test = logistic_regression_model.predict(X_test)
             plot_confusion_matrix(y_test, y_pred_test, accuracy_str)
 
     mean_accuracy = np.mean(accuracy_results)
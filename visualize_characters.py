@@ -1,5 +1,6 @@
 import argparse
 import os
+import shutil
 from pathlib import Path
 import string
 from copy import copy
@@ -8,6 +9,7 @@ import random
 import numpy as np
 from scipy.io import loadmat
 from scipy.ndimage import gaussian_filter1d
+from joblib import Parallel, delayed
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from matplotlib import pyplot as plt
@@ -35,6 +37,10 @@ CHAR_REPLACEMENTS = {
 }
 CHAR_TO_CLASS_MAP = {char: idx for idx, char in enumerate(ALL_CHARS)}
 CLASS_TO_CHAR_MAP = {idx: char for idx, char in enumerate(ALL_CHARS)}
+# The characters in sorted order alongside their classes, to convert whole arrays of
+# characters to classes with a binary search.
+SORTED_CHARS = np.array(sorted(ALL_CHARS))
+SORTED_CHAR_CLASSES = np.array([CHAR_TO_CLASS_MAP[char] for char in SORTED_CHARS])
 
 PRE_GO_CUE_BINS = 50
 POST_GO_CUE_BINS = 150
@@ -45,6 +51,18 @@ WARPING_ALPHAS = np.linspace(1.0, 2.0, 11)
 
 OUTPUTS_DIR = os.path.abspath("./outputs")
 
+# The arrays we use from each session's .mat file.
+MAT_KEYS = [
+    "neuralActivityTimeSeries",
+    "goPeriodOnsetTimeBin",
+    "delayPeriodOnsetTimeBin",
+    "characterCues",
+    "blockNumsTimeSeries",
+    "blockList",
+    "meansPerBlock",
+    "stdAcrossAllData",
+]
+
 
 ########################################################################################
 # Main function.
@@ -57,6 +75,11 @@ def main():
     args = parser.parse_args()
     save_plots = args.save_plots
 
+    # When just saving plots, use the non-interactive Agg backend to skip setting up GUI
+    # windows.
+    if save_plots:
+        plt.switch_backend("Agg")
+
     ## Load the data.
 
     data_dicts = load_data()
@@ -116,14 +139,88 @@ def load_data():
 
     data_dicts = []
     for filepath in letters_filepaths:
-        print(f"Loading {filepath} ...")
-        data_dict = loadmat(filepath)
+        # Convert the .mat file to .npy files the first time through (and again whenever
+        # the .mat file changes), so every load after that can memory-map the arrays
+        # instead of reading the whole file.
+        npy_dirpath = os.path.splitext(filepath)[0] + "_npy"
+        if not npy_dir_is_current(filepath, npy_dirpath):
+            print(f"Converting {filepath} ...")
+            convert_mat_to_npy(filepath, npy_dirpath)
+        print(f"Loading {npy_dirpath} ...")
+        data_dict = load_npy_dir(npy_dirpath)
         data_dicts.append(data_dict)
         # break  # for testing quickly
 
     return data_dicts
 
 
+def convert_mat_to_npy(mat_filepath, npy_dirpath):
+    """
+    Read a .mat file of session data and save the arrays we use from it as .npy files
+    in a new directory.
+    """
+    mat_dict = loadmat(mat_filepath)
+    arrays = {key: mat_dict[key] for key in MAT_KEYS}
+    # Work in float32 from here on, to halve the memory used by the neural data.
+    arrays["neuralActivityTimeSeries"] = arrays["neuralActivityTimeSeries"].astype(
+        np.float32
+    )
+    # Unwrap the cell array of characters into a plain array of strings, which (unlike
+    # an object array) can be memory-mapped.
+    arrays["characterCues"] = np.array([a[0] for a in arrays["characterCues"].ravel()])
+    # Record which version of the .mat file the arrays came from.
+    arrays["source_stat"] = get_source_stat(mat_filepath)
+    save_npy_dir(npy_dirpath, arrays)
+
+
+def get_source_stat(mat_filepath):
+    """
+    Get the size and modification time of a .mat file, to tell when it has changed.
+    """
+    file_stat = os.stat(mat_filepath)
+    return np.array([file_stat.st_size, file_stat.st_mtime_ns], dtype=np.int64)
+
+
+def npy_dir_is_current(mat_filepath, npy_dirpath):
+    """
+    Check whether a directory of .npy files was converted from the current version of
+    a .mat file.
+    """
+    source_stat_filepath = os.path.join(npy_dirpath, "source_stat.npy")
+    if not os.path.isfile(source_stat_filepath):
+        return False
+    return np.array_equal(np.load(source_stat_filepath), get_source_stat(mat_filepath))
+
+
+def save_npy_dir(dirpath, arrays):
+    """
+    Save a dict of arrays as .npy files (one per key) in a new directory.
+    """
+    # Write to a temporary directory and rename it at the end, so an interrupted save
+    # doesn't leave behind a partial directory that looks complete.
+    tmp_dirpath = dirpath + ".tmp"
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    Path(tmp_dirpath).mkdir(parents=True)
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_dirpath, f"{key}.npy"), array)
+    # Replace any outdated directory from an earlier save.
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.rename(tmp_dirpath, dirpath)
+
+
+def load_npy_dir(dirpath):
+    """
+    Memory-map each .npy file in a directory into a dict keyed by filename.
+    """
+    return {
+        os.path.splitext(filename)[0]: np.load(
+            os.path.join(dirpath, filename), mmap_mode="r"
+        )
+        for filename in sorted(os.listdir(dirpath))
+        if filename.endswith(".npy")
+    }
+
+
 def prepare_data(data_dicts):
     """
     Take the dicts of session data, z-score the neural data, slice up trials to get
@@ -132,65 +229,29 @@ def prepare_data(data_dicts):
 
     print("Preparing data ...")
 
-    trial_neural_activities = []
-    trial_labels = []
-    trial_session_idxs = []
-    trial_block_idxs = []
-    session_pca_models = []
-    for session_idx, data_dict in enumerate(data_dicts):
-        neural_activity = data_dict["neuralActivityTimeSeries"]
-        go_cue_bins = data_dict["goPeriodOnsetTimeBin"].ravel().astype(int)
-        prompts = [a[0] for a in data_dict["characterCues"].ravel()]
-        block_by_bin = data_dict["blockNumsTimeSeries"].ravel()
-        block_nums = data_dict["blockList"].ravel()
-        session_block_means = data_dict["meansPerBlock"]
-        session_stddevs = data_dict["stdAcrossAllData"]
-
-        # Z-score each block's data based on that block's mean and stddev.
-        zscored_neural_activity = np.zeros_like(neural_activity, dtype=np.float32)
-        for block_idx, block_num in enumerate(block_nums):
-            block_neural_activity = neural_activity[block_by_bin == block_num]
-            block_means = session_block_means[block_idx]
-            with np.errstate(divide="ignore", invalid="ignore"):
-                zscored_block_neural_activity = (
-                    block_neural_activity - block_means
-                ) / session_stddevs
-                zscored_block_neural_activity = np.nan_to_num(
-                    zscored_block_neural_activity, nan=0, posinf=0, neginf=0
-                )
-            zscored_neural_activity[
-                block_by_bin == block_num
-            ] = zscored_block_neural_activity
-
-        # Fit a PCA model (only on this session) with which to transform z-scored neural
-        # data.
-        smoothed_zscored_neural_activity = gaussian_filter1d(
-            zscored_neural_activity, sigma=3.0, axis=0
-        )
-        session_pca_model = PCA(n_components=NUM_PCS)
-        session_pca_model.fit(smoothed_zscored_neural_activity)
-        session_pca_models.append(session_pca_model)
-
-        print(f"Creating labeled pairs for session {session_idx} ...")
-        for trial_idx, go_cue_bin in enumerate(go_cue_bins):
-            # Get the training window for this trial.
-            window_start_bin = int(go_cue_bin) - PRE_GO_CUE_BINS
-            window_end_bin = int(go_cue_bin) + POST_GO_CUE_BINS
-            window_neural_activity = zscored_neural_activity[
-                window_start_bin:window_end_bin
-            ]
-
-            label = prompts[trial_idx]
-
-            trial_neural_activities.append(window_neural_activity)
-            trial_labels.append(label)
-            trial_session_idxs.append(session_idx)
-            trial_block_idxs.append(f"{session_idx}_{block_by_bin[go_cue_bin]}")
+    # Prepare each session in parallel, in separate processes.
+    session_results = Parallel(n_jobs=-1, prefer="processes")(
+        delayed(prepare_session_data)(data_dict, session_idx)
+        for session_idx, data_dict in enumerate(data_dicts)
+    )
 
-    trial_neural_activities = np.array(trial_neural_activities)
-    trial_labels = np.array(trial_labels)
-    trial_session_idxs = np.array(trial_session_idxs)
-    trial_block_idxs = np.array(trial_block_idxs)
+    # Join the sessions' trials together.
+    (
+        session_trial_neural_activities,
+        session_trial_labels,
+        session_trial_block_idxs,
+        session_pca_models,
+    ) = zip(*session_results)
+    trial_neural_activities = np.concatenate(session_trial_neural_activities)
+    trial_labels = np.concatenate(session_trial_labels)
+    trial_session_idxs = np.concatenate(
+        [
+            np.full(len(labels), session_idx)
+            for session_idx, labels in enumerate(session_trial_labels)
+        ]
+    )
+    trial_block_idxs = np.concatenate(session_trial_block_idxs)
+    session_pca_models = list(session_pca_models)
 
     return (
         trial_neural_activities,
@@ -201,6 +262,90 @@ def prepare_data(data_dicts):
     )
 
 
+def prepare_session_data(data_dict, session_idx):
+    """
+    Z-score one session's neural data, fit a PCA model on it, and slice up its trials
+    to get inputs and labels.
+    """
+
+    neural_activity = data_dict["neuralActivityTimeSeries"]
+    go_cue_bins = data_dict["goPeriodOnsetTimeBin"].ravel().astype(int)
+    prompts = data_dict["characterCues"]
+    block_by_bin = data_dict["blockNumsTimeSeries"].ravel()
+    block_nums = data_dict["blockList"].ravel()
+    session_block_means = data_dict["meansPerBlock"]
+    session_stddevs = data_dict["stdAcrossAllData"]
+
+    # Z-score each block's data based on that block's mean and stddev.
+    zscored_neural_activity = np.zeros_like(neural_activity, dtype=np.float32)
+    for block_idx, block_num in enumerate(block_nums):
+        block_neural_activity = neural_activity[block_by_bin == block_num]
+        block_means = session_block_means[block_idx]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            zscored_block_neural_activity = (
+                block_neural_activity - block_means
+            ) / session_stddevs
+            zscored_block_neural_activity = np.nan_to_num(
+                zscored_block_neural_activity, nan=0, posinf=0, neginf=0
+            )
+        zscored_neural_activity[
+            block_by_bin == block_num
+        ] = zscored_block_neural_activity
+
+    # Fit a PCA model (only on this session) with which to transform z-scored neural
+    # data.
+    smoothed_zscored_neural_activity = gaussian_filter1d(
+        zscored_neural_activity, sigma=3.0, axis=0
+    )
+    # Leave the solver choice to scikit-learn, which already picks a truncated solver
+    # for data this shape, but seed it so the plots are reproducible.
+    session_pca_model = PCA(
+        n_components=NUM_PCS, random_state=0, whiten=False, copy=False
+    )
+    session_pca_model.fit(smoothed_zscored_neural_activity)
+
+    print(f"Creating labeled pairs for session {session_idx} ...")
+    trial_neural_activities = []
+    trial_labels = []
+    trial_block_idxs = []
+    for trial_idx, go_cue_bin in enumerate(go_cue_bins):
+        # Get the training window for this trial.
+        window_start_bin = int(go_cue_bin) - PRE_GO_CUE_BINS
+        window_end_bin = int(go_cue_bin) + POST_GO_CUE_BINS
+        window_neural_activity = zscored_neural_activity[
+            window_start_bin:window_end_bin
+        ]
+
+        label = prompts[trial_idx]
+
+        trial_neural_activities.append(window_neural_activity)
+        trial_labels.append(label)
+        trial_block_idxs.append(f"{session_idx}_{block_by_bin[go_cue_bin]}")
+
+    return (
+        np.array(trial_neural_activities),
+        np.array(trial_labels),
+        np.array(trial_block_idxs),
+        session_pca_model,
+    )
+
+
+def transform_trials_with_pca(trial_neural_activities, pca_model):
+    """
+    Transform each trial's neural activity into PCs, doing all trials' time bins at once
+    as one big matrix multiply.
+    """
+    num_trials, num_bins, num_channels = trial_neural_activities.shape
+    components = pca_model.components_.T.astype(np.float32)
+    # Rather than centering every time bin on the PCA mean before projecting, project
+    # the mean too and subtract it from the (much smaller) projected data. This is only
+    # the same as PCA.transform because the PCA models aren't whitened.
+    mean_PCs = pca_model.mean_.astype(np.float32) @ components
+    trial_PCs = trial_neural_activities.reshape(-1, num_channels) @ components
+    trial_PCs -= mean_PCs
+    return trial_PCs.reshape(num_trials, num_bins, -1)
+
+
 def plot_PCs(
     trial_neural_activities,
     trial_labels,
@@ -224,45 +369,50 @@ def plot_PCs(
         ]
         session_trial_labels = trial_labels[trial_session_idxs == session_idx]
 
-        session_trial_PCs = np.array(
+        session_trial_PCs = transform_trials_with_pca(
+            session_trial_neural_activities, session_pca_models[session_idx]
+        )
+        # Group the trials by character with a single sort: once the trials are
+        # (stably) sorted by class, each character's trials are one contiguous stretch,
+        # whose bounds come from the counts of each class.
+        session_trial_classes = chars_to_classes(session_trial_labels)
+        is_known_class = session_trial_classes >= 0
+        session_trial_classes = session_trial_classes[is_known_class]
+        trial_order = np.argsort(session_trial_classes, kind="stable")
+        sorted_session_trial_PCs = session_trial_PCs[is_known_class][trial_order]
+        class_bounds = np.concatenate(
             [
-                session_pca_models[session_idx].transform(neural_activities)
-                for neural_activities in session_trial_neural_activities
+                [0],
+                np.cumsum(np.bincount(session_trial_classes, minlength=len(ALL_CHARS))),
             ]
         )
         session_trial_PCs_by_char = {
-            char: np.array(
-                [
-                    w
-                    for w, c in zip(session_trial_PCs, session_trial_labels)
-                    if c == char
-                ]
-            )
-            for char in ALL_CHARS
+            char: sorted_session_trial_PCs[
+                class_bounds[class_idx] : class_bounds[class_idx + 1]
+            ]
+            for class_idx, char in enumerate(ALL_CHARS)
         }
 
         NUM_PCS_TO_PLOT = 3
 
+        # Build the figure once and reuse it for each character, just swapping in the
+        # character's data. (When showing plots, closing the window destroys the figure,
+        # so it gets built again for the next character.)
+        fig = None
+
         for char in ALL_CHARS[:5]:
             if len(session_trial_PCs_by_char[char]) == 0:
                 continue
 
-            fig, axs = plt.subplots(1, NUM_PCS_TO_PLOT)
-
-            for pc_idx, ax in enumerate(axs):
-                ax.imshow(
-                    session_trial_PCs_by_char[char][:, :, pc_idx],
-                    cmap=colormaps["bwr"],
-                    aspect=3,
-                )
-
-                ax.axvline(PRE_GO_CUE_BINS, color="black")  # put a line at the go cue
+            if fig is None or not plt.fignum_exists(fig.number):
+                fig, axs, images = make_PCs_figure(NUM_PCS_TO_PLOT)
 
-                ax.set_xticks([0, 50, 100, 150])
-                ax.set_xticklabels([-0.5, 0.0, 0.5, 1.0])
-                ax.set_xlabel("time (s)")
-
-                ax.set_ylabel("trial")
+            for pc_idx, (ax, image) in enumerate(zip(axs, images)):
+                char_PCs = session_trial_PCs_by_char[char][:, :, pc_idx]
+                image.set_data(char_PCs)
+                num_trials, num_bins = char_PCs.shape
+                image.set_extent((-0.5, num_bins - 0.5, num_trials - 0.5, -0.5))
+                image.autoscale()
 
                 ax.set_title(f"{char} (PC{pc_idx + 1})")
 
@@ -275,11 +425,51 @@ def plot_PCs(
                 Path(OUTPUTS_DIR).mkdir(parents=True, exist_ok=True)
                 plot_filename = f"neural_activity_PCs_during_session_{session_idx}_{char}_trials.png"
                 plot_filepath = os.path.join(OUTPUTS_DIR, plot_filename)
-                plt.savefig(plot_filepath)
-                plt.close()
+                fig.savefig(plot_filepath)
             else:
                 plt.show()
 
+        if fig is not None:
+            plt.close(fig)
+
+
+def chars_to_classes(chars):
+    """
+    Convert an array of characters to an array of their classes, with -1 for any
+    characters that aren't one of the classes.
+    """
+    # Find where each character sits among the sorted characters and take the class
+    # there.
+    chars = np.asarray(chars)
+    sorted_idxs = np.searchsorted(SORTED_CHARS, chars)
+    sorted_idxs = np.minimum(sorted_idxs, len(SORTED_CHARS) - 1)
+    is_class = SORTED_CHARS[sorted_idxs] == chars
+    return np.where(is_class, SORTED_CHAR_CLASSES[sorted_idxs], -1)
+
+
+def make_PCs_figure(num_PCs):
+    """
+    Make a figure with a row of (empty) heatmaps of PC values across trials, one per PC,
+    to be filled in with set_data.
+    """
+
+    fig, axs = plt.subplots(1, num_PCs)
+
+    images = []
+    for ax in axs:
+        image = ax.imshow(np.zeros((1, 1)), cmap=colormaps["bwr"], aspect=3)
+        images.append(image)
+
+        ax.axvline(PRE_GO_CUE_BINS, color="black")  # put a line at the go cue
+
+        ax.set_xticks([0, 50, 100, 150])
+        ax.set_xticklabels([-0.5, 0.0, 0.5, 1.0])
+        ax.set_xlabel("time (s)")
+
+        ax.set_ylabel("trial")
+
+    return fig, axs, images
+
 
 def time_lengthen_and_slice_vector(y, alpha):
     """"""
@@ -397,20 +587,15 @@ def plot_tSNE(
         ]
         session_trial_labels = trial_labels[trial_session_idxs == session_idx]
 
-        # Smooth the neural activity over time.
-        session_trial_neural_activities_smoothed = np.array(
-            [
-                gaussian_filter1d(w, sigma=3.0, axis=0)
-                for w in session_trial_neural_activities
-            ]
+        # Smooth the neural activity over time (all trials at once, along the time
+        # axis).
+        session_trial_neural_activities_smoothed = gaussian_filter1d(
+            session_trial_neural_activities, sigma=3.0, axis=1
         )
         # Transform the neural activity using our PCA model trained on all sessions.
         session_pca_model = session_pca_models[session_idx]
-        session_trial_PCs = np.array(
-            [
-                session_pca_model.transform(w)
-                for w in session_trial_neural_activities_smoothed
-            ]
+        session_trial_PCs = transform_trials_with_pca(
+            session_trial_neural_activities_smoothed, session_pca_model
         )
         # Take just the window starting soon after the go cue.
         session_trial_PCs_windowed = session_trial_PCs[
@@ -427,7 +612,14 @@ def plot_tSNE(
         print("Fitting t-SNE model ...")
 
         PERPLEXITY = 10
-        tsne_model = TSNE(perplexity=PERPLEXITY, metric=dist_with_time_warp)
+        # Pin the init and learning rate to scikit-learn's current defaults, so results
+        # don't change across versions.
+        tsne_model = TSNE(
+            perplexity=PERPLEXITY,
+            metric=dist_with_time_warp,
+            init="pca",
+            learning_rate="auto",
+        )
         trials_projected = tsne_model.fit_transform(session_trial_PCs_flattened)
 
         ## Plot the t-SNE-projected trials in 2D space, colored by character to see if